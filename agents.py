@@ -1,18 +1,128 @@
 # agents.py
+import logging
+import os
+import sqlite3
+import threading
+
 from dotenv import load_dotenv
 load_dotenv()
 
-from crewai import Agent
-from langchain_openai import ChatOpenAI  # requires OPENAI_API_KEY in .env
+from crewai import Agent, LLM  # LLM requires OPENAI_API_KEY in .env
+
+from cache import llm_cache, prompt_key
+from rate_limit import RateLimiter
+from schemas import CompositeOut
+
+logger = logging.getLogger(__name__)
+
+
+# --- OpenAI throttle ---
+# Per-agent max_rpm doesn't bound the total once crews fan out and requests overlap;
+# cap in-flight calls and requests/minute here so bursts don't turn into 429 backoff.
+# The limits are for the whole host: each of the WEB_CONCURRENCY server processes
+# (gunicorn.conf.py / main.py export it) enforces its share.
+_WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+OPENAI_SEM = threading.BoundedSemaphore(
+    max(1, int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")) // _WEB_CONCURRENCY)
+)
+OPENAI_RPM_LIMITER = RateLimiter(
+    max(1, int(os.getenv("OPENAI_MAX_RPM", "60")) // _WEB_CONCURRENCY), period=60.0
+)
+
+
+class CachedLLM(LLM):
+    """
+    CrewAI LLM that serves repeated prompts from the shared response cache.
+    CrewAI converts any LangChain chat model into its own LLM before calling it,
+    so caching has to live at this layer to see every request.
+    Cache misses go through the process-wide OpenAI throttle. With a pydantic
+    response_format, only responses that validate against it are cached.
+    """
+
+    def _throttled_call(self, messages, tools, callbacks, available_functions, **kwargs):
+        OPENAI_RPM_LIMITER.acquire()
+        with OPENAI_SEM:
+            return super().call(messages, tools, callbacks, available_functions, **kwargs)
+
+    def _is_cacheable(self, response) -> bool:
+        """Only non-empty text, and for structured output only responses that parse."""
+        if not isinstance(response, str) or not response:
+            return False
+        response_format = getattr(self, "response_format", None)
+        if hasattr(response_format, "model_validate_json"):
+            try:
+                response_format.model_validate_json(response)
+            except ValueError:  # pydantic.ValidationError; e.g. truncated at max_tokens
+                return False
+        return True
+
+    def call(self, messages, tools=None, callbacks=None, available_functions=None, **kwargs):
+        # Tool/function-calling responses aren't plain text; don't cache them.
+        if tools or available_functions:
+            return self._throttled_call(messages, tools, callbacks, available_functions, **kwargs)
+
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+        response_format = getattr(self, "response_format", None)
+        key = prompt_key(
+            self.model, self.temperature, self.max_tokens, messages,
+            stop=getattr(self, "stop", None),
+            response_format=(
+                response_format.model_json_schema()
+                if hasattr(response_format, "model_json_schema") else response_format
+            ),
+        )
+
+        # The cache is an optimization: a locked or broken database is just a miss
+        try:
+            cached = llm_cache.get(key)
+        except sqlite3.Error:
+            logger.warning("LLM cache read failed; calling the model", exc_info=True)
+            cached = None
+        # Entries written before validation existed may not parse; those are re-fetched
+        if cached is not None and self._is_cacheable(cached):
+            return cached
 
-from tools import search_tool, financial_pdf_tool
+        response = self._throttled_call(messages, tools, callbacks, available_functions, **kwargs)
+        if self._is_cacheable(response):
+            try:
+                llm_cache.set(key, response, model=self.model)
+            except sqlite3.Error:
+                logger.warning("LLM cache write failed", exc_info=True)
+        return response
 
 
-# --- LLM (adjust model if needed) ---
-llm = ChatOpenAI(
+# --- LLMs (adjust models if needed) ---
+# Full budget for the analyst and advisor
+llm = CachedLLM(
     model="gpt-4o-mini",
     temperature=0.2,
     max_tokens=1500,
+    stream=True,  # tokens surface as LLMStreamChunkEvents for /analyze/stream
+)
+
+# Verifier only returns a yes/no + confidence JSON; deterministic so it caches
+llm_small = CachedLLM(
+    model="gpt-4o-mini",
+    temperature=0,
+    max_tokens=128,
+    stream=True,
+)
+
+# Risk assessor keeps the full budget but runs deterministically
+llm_deterministic = CachedLLM(
+    model="gpt-4o-mini",
+    temperature=0,
+    max_tokens=1500,
+    stream=True,
+)
+
+# Small-document fast path: all four sections in one structured call
+llm_composite = CachedLLM(
+    model="gpt-4o-mini",
+    temperature=0.2,
+    max_tokens=4000,
+    response_format=CompositeOut,
 )
 
 # --- Agents ---
@@ -26,13 +136,13 @@ financial_analyst = Agent(
         "Experienced analyst specializing in corporate statements and earnings reports. "
         "Provides concise, evidence-backed insights."
     ),
-    tools=[financial_pdf_tool, search_tool],
+    tools=[],  # web search is attached per task, only when a request opts in
     llm=llm,
     verbose=True,
     memory=False,
     max_iter=3,
     max_rpm=3,
-    allow_delegation=True,
+    allow_delegation=False,
 )
 
 verifier = Agent(
@@ -44,8 +154,8 @@ verifier = Agent(
         "Validation and compliance expert. Checks presence of statements, revenue data, "
         "and typical financial terminology."
     ),
-    tools=[financial_pdf_tool],
-    llm=llm,
+    tools=[],
+    llm=llm_small,
     verbose=True,
     memory=False,
     max_iter=2,
@@ -61,7 +171,7 @@ investment_advisor = Agent(
     backstory=(
         "Independent advisor with deep market knowledge; balances upside with risks and compliance."
     ),
-    tools=[financial_pdf_tool],
+    tools=[],
     llm=llm,
     verbose=True,
     memory=False,
@@ -78,8 +188,8 @@ risk_assessor = Agent(
     backstory=(
         "Professional risk manager specializing in risk factors in corporate reports."
     ),
-    tools=[financial_pdf_tool],
-    llm=llm,
+    tools=[],
+    llm=llm_deterministic,
     verbose=True,
     memory=False,
     max_iter=3,
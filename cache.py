@@ -0,0 +1,280 @@
+# cache.py
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import IO, Any, Dict, List, Optional, Union
+
+import numpy as np
+from dotenv import load_dotenv
+load_dotenv()
+
+from openai import OpenAI  # requires OPENAI_API_KEY in .env
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+_openai_client: Optional[OpenAI] = None
+
+
+def file_sha256(source: Union[str, os.PathLike, IO[bytes], bytes], chunk_size: int = 1 << 20) -> str:
+    """Content hash of a file (path, open binary file, or bytes), streamed in 1 MiB chunks."""
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).hexdigest()
+
+    digest = hashlib.sha256()
+    if hasattr(source, "read"):
+        source.seek(0)
+        while chunk := source.read(chunk_size):
+            digest.update(chunk)
+        source.seek(0)
+        return digest.hexdigest()
+
+    with open(source, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def embed_query(text: str) -> np.ndarray:
+    """Unit-normalized embedding of `text`, so a dot product is cosine similarity."""
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = OpenAI()
+    response = _openai_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+def _normalize(value: Any) -> Any:
+    """NFC-normalize every string so visually identical prompts hash identically."""
+    if isinstance(value, str):
+        return unicodedata.normalize("NFC", value)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def prompt_key(model: str, temperature: Optional[float], max_tokens: Optional[int],
+               messages: List[Dict[str, Any]], **extra: Any) -> str:
+    """
+    Deterministic SHA-256 key over the fields that affect the completion.
+    Transport-only fields (stream, user, api_key) are deliberately left out.
+    """
+    payload = {
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "messages": _normalize(messages),
+        **extra,
+    }
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _connect(database_path: str) -> sqlite3.Connection:
+    """
+    Connection shared by this process's threads. Gunicorn workers share the file,
+    so use WAL (readers don't block the writer) and wait out brief write locks.
+    """
+    conn = sqlite3.connect(database_path, check_same_thread=False, timeout=5.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class LLMResponseCache:
+    """
+    SQLite-backed prompt → response cache with TTL expiry and LRU eviction.
+    Safe to share between the threads CrewAI runs agents on.
+    """
+
+    def __init__(self, database_path: str = ".llm_cache.db", ttl_seconds: int = 86400,
+                 max_entries: int = 1024):
+        self.database_path = database_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        self._conn = _connect(database_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " model TEXT,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at, last_access FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            response, created_at, last_access = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self._misses += 1
+                return None
+            # Bump recency for LRU eviction; at most once a minute so hot keys don't
+            # turn every read into a write
+            if now - last_access > 60:
+                self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            self._hits += 1
+            return json.loads(response)
+
+    def set(self, key: str, response: str, model: Optional[str] = None) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, model, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(response), model, now, now),
+            )
+            if self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN ("
+                    " SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+            self._hits = 0
+            self._misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            (size,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "size": size,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+
+class SemanticResultCache:
+    """
+    Maps (file hash, query embedding) → analysis result so paraphrased queries
+    against an already-analyzed document are answered without re-running the crew.
+    Entries are scoped by file hash to prevent cross-document hits; the
+    per-document index is small (capped at `max_per_file` most recent rows,
+    expired after `ttl_seconds`), so a brute-force cosine scan is enough.
+    """
+
+    def __init__(self, database_path: str = "data/cache/semantic_cache.db", threshold: float = 0.92,
+                 ttl_seconds: int = 86400, max_per_file: int = 32,
+                 embedding_model: str = EMBEDDING_MODEL):
+        self.database_path = database_path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_per_file = max_per_file
+        # Vectors from different embedding models aren't comparable (or even the same size)
+        self.embedding_model = embedding_model
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self._conn = _connect(database_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " file_hash TEXT NOT NULL,"
+            " query TEXT NOT NULL,"
+            " embedding BLOB NOT NULL,"
+            " result TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(semantic_cache)")}
+        if "embedding_model" not in columns:
+            # Rows from before this column existed have no model and never match
+            self._conn.execute("ALTER TABLE semantic_cache ADD COLUMN embedding_model TEXT")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS semantic_cache_file_hash ON semantic_cache (file_hash)"
+        )
+        self._conn.commit()
+
+    def lookup(self, file_hash: str, query_vector: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return the cached result of the most similar prior query, if above threshold."""
+        min_created_at = time.time() - self.ttl_seconds if self.ttl_seconds else 0.0
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT embedding, result FROM semantic_cache"
+                " WHERE file_hash = ? AND embedding_model = ? AND created_at >= ?",
+                (file_hash, self.embedding_model, min_created_at),
+            ).fetchall()
+        # Also guard on size, in case the same model name ever returns other dimensions
+        rows = [row for row in rows if len(row[0]) == query_vector.astype(np.float32).nbytes]
+        if not rows:
+            return None
+
+        matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for blob, _ in rows])
+        scores = matrix @ query_vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return json.loads(rows[best][1])
+
+    def insert(self, file_hash: str, query: str, query_vector: np.ndarray,
+               result: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO semantic_cache"
+                " (file_hash, query, embedding, result, created_at, embedding_model)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    file_hash,
+                    query,
+                    query_vector.astype(np.float32).tobytes(),
+                    json.dumps(result, default=str),
+                    now,
+                    self.embedding_model,
+                ),
+            )
+            if self.ttl_seconds:
+                self._conn.execute(
+                    "DELETE FROM semantic_cache WHERE file_hash = ? AND created_at < ?",
+                    (file_hash, now - self.ttl_seconds),
+                )
+            if self.max_per_file:
+                # Keep only the newest rows for this document
+                self._conn.execute(
+                    "DELETE FROM semantic_cache WHERE file_hash = ? AND id NOT IN ("
+                    " SELECT id FROM semantic_cache WHERE file_hash = ?"
+                    " ORDER BY id DESC LIMIT ?)",
+                    (file_hash, file_hash, self.max_per_file),
+                )
+            self._conn.commit()
+
+
+# --- Shared instances ---
+llm_cache = LLMResponseCache(
+    database_path=os.getenv("LLM_CACHE_PATH", ".llm_cache.db"),
+    ttl_seconds=int(os.getenv("LLM_CACHE_TTL_SECONDS", "86400")),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+)
+
+semantic_cache = SemanticResultCache(
+    database_path=os.getenv("SEMANTIC_CACHE_PATH", "data/cache/semantic_cache.db"),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+    ttl_seconds=int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))),
+    max_per_file=int(os.getenv("SEMANTIC_CACHE_MAX_PER_FILE", "32")),
+)
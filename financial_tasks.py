@@ -1,17 +1,21 @@
 # financial_tasks.py
 from crewai import Task
 from agents import financial_analyst, verifier, investment_advisor, risk_assessor
-from tools import search_tool, financial_pdf_tool
+from schemas import VerificationOut, AnalysisOut, InvestmentOut, RiskOut
+from tools import search_tool
 
-# Use the same reader instance everywhere to keep behavior consistent
+# The PDF is parsed once before kickoff (see main.run_crew); analysis receives it as
+# {extracted_text}, verification only its opening as {verification_text}.
+# Investment and risk only see the analyst's compact {facts_json}.
+# Each task runs in its own crew, so outputs flow between them as kickoff inputs, not context=.
 
 # 1) Verification (run first)
 verification = Task(
     description=(
-        "Verify the uploaded document at {file_path} is a financial report. "
-        "Use the Financial Document Reader with path={file_path} to inspect contents. "
-        "Confirm presence of financial terminology (e.g., revenue, EBITDA, net income, cash flow), "
-        "tables, or statements. Reject unrelated files."
+        "Verify the uploaded document is a financial report, using the start of its extracted "
+        "text below. Confirm presence of financial terminology (e.g., revenue, EBITDA, net income, "
+        "cash flow), tables, or statements. Reject unrelated files.\n\n"
+        "Document text (opening pages):\n{verification_text}"
     ),
     expected_output="""
 {
@@ -21,19 +25,22 @@ verification = Task(
 }
 """.strip(),
     agent=verifier,
-    tools=[financial_pdf_tool],
+    tools=[],
+    output_json=VerificationOut,
     async_execution=False,
 )
 
 # 2) Analysis
-analyze_financial_document = Task(
-    description=(
-        "Analyze the financial document at {file_path}. "
-        "Use the Financial Document Reader with path={file_path}. "
-        "Extract company name, period, KPIs (revenue, net income, margins, EPS, FCF if present), "
-        "guidance/outlook, and notable highlights with page references when possible."
-    ),
-    expected_output="""
+ANALYSIS_DESCRIPTION = (
+    "Analyze the financial document whose extracted text is below. "
+    "Extract company name, period, KPIs (revenue, net income, margins, EPS, FCF if present), "
+    "guidance/outlook, and notable highlights with page references when possible. "
+    "Also quote a few short excerpts (at most ~200 tokens each, with page numbers) covering "
+    "valuation, debt/liquidity, regulatory and operational risks; downstream analysts will "
+    "see only your output, not the document.\n\n"
+    "Document text:\n{extracted_text}"
+)
+ANALYSIS_EXPECTED_OUTPUT = """
 {
   "company": "Company Name",
   "period": "e.g., Q2 2025 or FY2024",
@@ -42,24 +49,48 @@ analyze_financial_document = Task(
     {"name": "Net Income", "value": "X.XXB", "unit": "USD", "source_page": 4}
   ],
   "highlights": ["Summary point 1", "Summary point 2"],
-  "guidance": ["Forward-looking statements or outlook if present"]
+  "guidance": ["Forward-looking statements or outlook if present"],
+  "excerpts": [
+    {"text": "Short verbatim passage on debt, liquidity, or risk", "source_page": 12}
+  ]
 }
-""".strip(),
+""".strip()
+
+# Default: strictly in-document, no external I/O
+analyze_financial_document = Task(
+    description=ANALYSIS_DESCRIPTION,
+    expected_output=ANALYSIS_EXPECTED_OUTPUT,
     agent=financial_analyst,
-    tools=[financial_pdf_tool, search_tool],
+    tools=[],
+    output_json=AnalysisOut,
+    async_execution=False,
+)
+
+# 2b) Analysis with web search (opt-in per request: each Serper call adds latency and cost)
+analyze_financial_document_web = Task(
+    description=(
+        ANALYSIS_DESCRIPTION
+        + "\n\nYou may use web search for market context the document does not cover."
+    ),
+    expected_output=ANALYSIS_EXPECTED_OUTPUT,
+    agent=financial_analyst,
+    tools=[search_tool],
+    output_json=AnalysisOut,
     async_execution=False,
 )
 
 # 3) Investment Analysis
 investment_analysis = Task(
     description=(
-        "Using the analysis results, provide investment insights. "
-        "Decide Buy/Hold/Sell with clear evidence, both bull and bear cases, "
-        "and list near-term catalysts. Consider valuation/risks if mentioned in the document."
+        "Using the facts extracted from the document (JSON below), provide investment insights. "
+        "Decide on a stance of exactly one of \"buy\", \"hold\" or \"sell\" (lowercase) "
+        "with clear evidence, give both bull and bear cases, "
+        "and list near-term catalysts. Consider valuation/risks if mentioned in the facts.\n\n"
+        "Facts:\n{facts_json}"
     ),
     expected_output="""
 {
-  "stance": "buy|hold|sell",
+  "stance": "hold",
   "bull_case": "Reasons supporting upside potential",
   "bear_case": "Risks or reasons for caution",
   "catalysts": ["Upcoming events or trends that may impact performance"],
@@ -67,16 +98,18 @@ investment_analysis = Task(
 }
 """.strip(),
     agent=investment_advisor,
-    tools=[financial_pdf_tool],
+    tools=[],
+    output_json=InvestmentOut,
     async_execution=False,
 )
 
 # 4) Risk Assessment
 risk_assessment = Task(
     description=(
-        "Evaluate the key risks evident in the document at {file_path}. "
+        "Evaluate the key risks evident in the facts extracted from the document (JSON below). "
         "Identify risk categories such as regulatory, liquidity, market, and operational. "
-        "Provide a brief justification with page/section reference if possible."
+        "Provide a brief justification, citing excerpt or KPI page references where available.\n\n"
+        "Facts:\n{facts_json}"
     ),
     expected_output="""
 {
@@ -95,6 +128,24 @@ risk_assessment = Task(
 }
 """.strip(),
     agent=risk_assessor,
-    tools=[financial_pdf_tool],
+    tools=[],
+    output_json=RiskOut,
     async_execution=False,
 )
+
+
+# 5) Single-call fast path for small documents (replaces tasks 1-4; see main.run_fast_analysis)
+FAST_ANALYSIS_PROMPT = (
+    "You are a team of four financial specialists working in one pass on the document text below. "
+    "User request: {query}\n\n"
+    "Return a single JSON object with these sections:\n"
+    "- verification: is this a financial report? Check for financial terminology "
+    "(revenue, EBITDA, net income, cash flow), tables, or statements; give a confidence score and reason.\n"
+    "- analysis: company name, period, KPIs (revenue, net income, margins, EPS, FCF if present), "
+    "guidance/outlook, notable highlights, and a few short supporting excerpts with page references.\n"
+    "- investment: stance (exactly one of \"buy\", \"hold\" or \"sell\", lowercase) "
+    "with bull and bear cases, near-term catalysts, "
+    "and a time horizon in months, based on the analysis.\n"
+    "- risk: key regulatory, liquidity, market, and operational risks, each with evidence.\n\n"
+    "Document text:\n{extracted_text}"
+)
@@ -0,0 +1,21 @@
+# gunicorn.conf.py
+# Production: gunicorn -c gunicorn.conf.py main:app
+import multiprocessing
+import os
+
+from uvicorn.workers import UvicornWorker
+
+
+class UvloopWorker(UvicornWorker):
+    """Uvicorn worker pinned to uvloop (libuv event loop) and httptools (C HTTP parser)."""
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# One process per core: PDF parsing is CPU-bound and each worker has its own GIL
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = UvloopWorker
+# Lets each worker size its PDF parse pool to its share of the cores
+raw_env = [f"WEB_CONCURRENCY={workers}"]
+# Analyses are long-running LLM pipelines; don't kill workers mid-request
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
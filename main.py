@@ -1,87 +1,414 @@
 # app.py
+import asyncio
+import json
+import logging
 import os
 import uuid
 import shutil
-from typing import Dict, Any
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Any, Optional, Tuple
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import BackgroundTasks, FastAPI, File, UploadFile, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from crewai import Crew, Process
+from crewai.utilities.events import crewai_event_bus, LLMStreamChunkEvent
 
-from agents import financial_analyst, verifier, investment_advisor, risk_assessor
+from cache import embed_query, file_sha256, llm_cache, semantic_cache
+from tools import PdfSource, financial_document_reader
+from agents import financial_analyst, verifier, investment_advisor, risk_assessor, llm_composite
 from financial_tasks import (
     verification,
     analyze_financial_document,
+    analyze_financial_document_web,
     investment_analysis,
     risk_assessment,
+    FAST_ANALYSIS_PROMPT,
 )
+from pydantic import ValidationError
+from schemas import CompositeOut, VerificationOut
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Financial Document Analyzer")
 
+# Upper bound on crews kicked off concurrently by a single request's fan-out.
+MAX_PARALLEL_AGENTS = int(os.getenv("MAX_PARALLEL_AGENTS", "2"))
+
+# Number of prebuilt crew pipelines, i.e. analyses that can run the crews concurrently.
+CREW_POOL_SIZE = int(os.getenv("CREW_POOL_SIZE", "4"))
+
+DEFAULT_QUERY = "Analyze this financial document for investment insights"
+
+# Upload copy buffer; shutil's 16 KiB default means ~1300 read/write pairs per 20 MB PDF
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Uploads up to this size are parsed from the request's own spooled file and never touch data/
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(8 << 20)))
+
+# Verifier verdicts below this confidence are treated as "not a financial document"
+MIN_VERIFICATION_CONFIDENCE = float(os.getenv("MIN_VERIFICATION_CONFIDENCE", "0.5"))
+
+# Documents whose normalized text is shorter than this go through one composite LLM call
+FAST_PATH_MAX_CHARS = int(os.getenv("FAST_PATH_MAX_CHARS", "30000"))
+
+# The verifier only needs the opening pages to tell a financial report from anything else
+VERIFICATION_MAX_CHARS = int(os.getenv("VERIFICATION_MAX_CHARS", "12000"))
+
+# --- Progress streaming ---
+# Set per request; kickoff_async runs crews via asyncio.to_thread, which copies
+# contextvars, so LLM events raised on worker threads still reach the right client.
+_progress_sink: ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = ContextVar(
+    "progress_sink", default=None
+)
+_current_stage: ContextVar[str] = ContextVar("current_stage", default="")
+
+
+def _emit(event: Dict[str, Any]) -> None:
+    sink = _progress_sink.get()
+    if sink is not None:
+        sink(event)
+
 
-def build_financial_crew() -> Crew:
+@crewai_event_bus.on(LLMStreamChunkEvent)
+def _forward_stream_chunk(source: Any, event: LLMStreamChunkEvent) -> None:
+    _emit({"stage": _current_stage.get(), "delta": event.chunk})
+
+
+def build_financial_crew() -> Dict[str, Crew]:
     """
-    Assemble the full verification → analysis → investment → risk pipeline.
+    Assemble the pipeline as a gated fan-out:
+    verification alone first (non-financial uploads stop there), then analysis,
+    then investment and risk side by side.
+    Both downstream crews consume the analyst's facts table via the {facts_json} input.
+    Analysis comes in two variants: offline (default) and with web search.
     """
-    return Crew(
-        agents=[verifier, financial_analyst, investment_advisor, risk_assessor],
-        tasks=[
-            verification,
-            analyze_financial_document,
-            investment_analysis,
-            risk_assessment,
-        ],
+    verification_crew = Crew(
+        agents=[verifier],
+        tasks=[verification],
         process=Process.sequential,
         verbose=True,
     )
+    analysis_crew = Crew(
+        agents=[financial_analyst],
+        tasks=[analyze_financial_document],
+        process=Process.sequential,
+        verbose=True,
+    )
+    analysis_web_crew = Crew(
+        agents=[financial_analyst],
+        tasks=[analyze_financial_document_web],
+        process=Process.sequential,
+        verbose=True,
+    )
+    advisor_crew = Crew(
+        agents=[investment_advisor],
+        tasks=[investment_analysis],
+        process=Process.sequential,
+        verbose=True,
+    )
+    risk_crew = Crew(
+        agents=[risk_assessor],
+        tasks=[risk_assessment],
+        process=Process.sequential,
+        verbose=True,
+    )
+    return {
+        "verification": verification_crew,
+        "analysis": analysis_crew,
+        "analysis_web": analysis_web_crew,
+        "advisor": advisor_crew,
+        "risk": risk_crew,
+    }
 
 
-def run_crew(query: str, file_path: str) -> Dict[str, Any]:
-    """
-    Run the financial analysis crew with shared inputs: query + file_path.
-    All tasks/agents can reference {file_path} and {query}.
-    """
-    financial_crew = build_financial_crew()
+# --- Prebuilt crews ---
+# Built once at import; {query}/{extracted_text}/... are substituted at kickoff, not build time.
+# kickoff() mutates a crew's tasks (interpolated descriptions, outputs), so a crew isn't
+# reentrant: each in-flight analysis checks out its own copy of the pipeline from the pool.
+FINANCIAL_CREW = build_financial_crew()
+_crew_pool: "asyncio.Queue[Dict[str, Crew]]" = asyncio.Queue()
+for _ in range(CREW_POOL_SIZE):
+    _crew_pool.put_nowait({name: crew.copy() for name, crew in FINANCIAL_CREW.items()})
+
+
+@asynccontextmanager
+async def _checkout_crews():
+    crews = await _crew_pool.get()
+    try:
+        yield crews
+    except asyncio.CancelledError:
+        # A cancelled kickoff's worker thread may still be using these crews; retire them
+        crews = {name: crew.copy() for name, crew in FINANCIAL_CREW.items()}
+        raise
+    finally:
+        _crew_pool.put_nowait(crews)
+
 
-    # These inputs are available in task descriptions as {file_path} and {query}
-    result = financial_crew.kickoff(inputs={"query": query, "file_path": file_path})
+def _save_upload(upload: UploadFile, file_path: str) -> None:
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(upload.file, f, length=UPLOAD_CHUNK_SIZE)
 
+
+def _crew_output_to_dict(result: Any) -> Dict[str, Any]:
     # Crew returns a structured object. Convert to a simple dict/string as you need.
     # Some Crew versions return a string; others a richer type. Safely stringify here.
+    if isinstance(result, BaseException):
+        return {"error": str(result)}
     try:
         return result.to_dict() if hasattr(result, "to_dict") else {"result": str(result)}
     except Exception:
         return {"result": str(result)}
 
 
+def _rejection(verification_output: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Rejection payload if the verifier says this isn't a financial document, else None."""
+    try:
+        verdict = VerificationOut.model_validate(verification_output)
+    except ValidationError:
+        # An unparseable verdict shouldn't block analysis of a possibly valid filing
+        return None
+    if verdict.is_financial_document and verdict.confidence_score >= MIN_VERIFICATION_CONFIDENCE:
+        return None
+    return {"status": "rejected", "reason": verdict.reason, "verification": verdict.model_dump()}
+
+
+def run_fast_analysis(query: str, extracted_text: str) -> Dict[str, Any]:
+    """
+    Verification, analysis, investment and risk in a single structured LLM call.
+    Only used for documents small enough to fit comfortably in one prompt.
+    """
+    prompt = FAST_ANALYSIS_PROMPT.format(query=query, extracted_text=extracted_text)
+    response = llm_composite.call([{"role": "user", "content": prompt}])
+    composite = CompositeOut.model_validate_json(response)
+    rejection = _rejection(composite.verification.model_dump())
+    if rejection is not None:
+        return rejection
+    return {
+        "verification": composite.verification.model_dump(),
+        "analysis": composite.analysis.model_dump(),
+        "investment_analysis": composite.investment.model_dump(),
+        "risk_assessment": composite.risk.model_dump(),
+    }
+
+
+async def _run_pipeline(
+    inputs: Dict[str, Any], enable_web_search: bool = False
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Multi-agent crews: verification, then analysis, then investment and risk in parallel.
+    Stops after verification for non-financial documents.
+    Returns the aggregated result and whether it is complete enough to cache.
+    """
+    async with _checkout_crews() as crews:
+        _current_stage.set("verification")
+        verification_result = await crews["verification"].kickoff_async(inputs=inputs)
+        verification_output = _crew_output_to_dict(verification_result)
+        _emit({"stage": "verification", "output": verification_output})
+
+        # Skip the three remaining LLM stages for uploads that aren't financial reports.
+        rejection = _rejection(verification_output)
+        if rejection is not None:
+            return rejection, True
+
+        _current_stage.set("analysis")
+        analysis_crew = crews["analysis_web" if enable_web_search else "analysis"]
+        analysis_result = await analysis_crew.kickoff_async(inputs=inputs)
+        analysis_output = _crew_output_to_dict(analysis_result)
+        # to_dict() is empty when the answer didn't convert to AnalysisOut (truncated or
+        # loosely formatted); pass the analyst's raw text on rather than "{}", and don't
+        # cache the result.
+        analysis_structured = bool(analysis_output)
+        if analysis_structured:
+            facts_json = json.dumps(analysis_output, ensure_ascii=False, default=str)
+        else:
+            facts_json = getattr(analysis_result, "raw", None) or str(analysis_result)
+            analysis_output = {"result": facts_json}
+        _emit({"stage": "analysis", "output": analysis_output})
+
+        # Investment and risk only depend on the analysis, not on each other, and only
+        # see its compact facts table rather than the full document text.
+        downstream_inputs = {"query": inputs["query"], "facts_json": facts_json}
+        semaphore = asyncio.Semaphore(MAX_PARALLEL_AGENTS)
+
+        async def _kickoff(crew: Crew, stage: str) -> Any:
+            # Each gather() branch runs in its own context copy, so stages don't collide.
+            _current_stage.set(stage)
+            async with semaphore:
+                output = await crew.kickoff_async(inputs=downstream_inputs)
+            _emit({"stage": stage, "output": _crew_output_to_dict(output)})
+            return output
+
+        # return_exceptions=True so one failed branch doesn't abort the other.
+        investment_result, risk_result = await asyncio.gather(
+            _kickoff(crews["advisor"], "investment_analysis"),
+            _kickoff(crews["risk"], "risk_assessment"),
+            return_exceptions=True,
+        )
+
+    result = {
+        "verification": verification_output,
+        "analysis": analysis_output,
+        "investment_analysis": _crew_output_to_dict(investment_result),
+        "risk_assessment": _crew_output_to_dict(risk_result),
+    }
+    complete = analysis_structured and not any(
+        isinstance(r, BaseException) for r in (investment_result, risk_result)
+    )
+    return result, complete
+
+
+async def run_crew(query: str, document: PdfSource, enable_web_search: bool = False) -> Dict[str, Any]:
+    """
+    Run the financial analysis crews for `query` against `document`, either a
+    path on disk or an in-memory upload.
+    The PDF is parsed once up front; analysis reads it as {extracted_text}, the verifier only
+    its opening as {verification_text}, and the investment and risk tasks only receive the
+    analyst's facts table as {facts_json}.
+    Small documents skip the crews and use a single composite LLM call instead.
+    Documents the verifier rejects return {"status": "rejected", ...} early.
+    The analyst only gets web search when `enable_web_search` is set.
+    Paraphrases of a query already answered for the same document are served
+    from the semantic cache.
+    """
+    file_hash = await run_in_threadpool(file_sha256, document)
+    # Web-augmented results differ from in-document ones; keep them in separate cache scopes
+    cache_scope = f"{file_hash}:web" if enable_web_search else file_hash
+    try:
+        query_vector = await run_in_threadpool(embed_query, query)
+    except Exception:
+        # Embedding outages shouldn't block analysis; just skip the cache.
+        query_vector = None
+
+    if query_vector is not None:
+        try:
+            cached = await run_in_threadpool(semantic_cache.lookup, cache_scope, query_vector)
+        except Exception:
+            # Same for a broken or incompatible cache: treat it as a miss.
+            logger.warning("Semantic cache lookup failed; running the analysis", exc_info=True)
+            cached = None
+        if cached is not None:
+            return cached
+
+    # One parse per upload (and per content hash across uploads), instead of one per agent
+    extracted_text = await run_in_threadpool(financial_document_reader.read, document, file_hash)
+
+    result, complete = None, True
+    # The composite call has no tools, so web-search requests always use the crews
+    if len(extracted_text) < FAST_PATH_MAX_CHARS and not enable_web_search:
+        _current_stage.set("fast_analysis")
+        try:
+            result = await run_in_threadpool(run_fast_analysis, query, extracted_text)
+            if result.get("status") != "rejected":
+                for stage, output in result.items():
+                    _emit({"stage": stage, "output": output})
+        except ValueError:  # includes pydantic.ValidationError
+            # Malformed composite output: fall back to the per-section crews. Transport
+            # errors (auth, rate limits, network) propagate; the crews would hit them too.
+            logger.warning("Composite fast path returned invalid output; using the crews",
+                           exc_info=True)
+            result = None
+
+    if result is None:
+        # These inputs are available in task descriptions as {query}, {extracted_text}
+        # and {verification_text}
+        inputs = {
+            "query": query,
+            "extracted_text": extracted_text,
+            "verification_text": extracted_text[:VERIFICATION_MAX_CHARS],
+        }
+        result, complete = await _run_pipeline(inputs, enable_web_search)
+
+    # Don't pin a partial result for every future paraphrase.
+    if query_vector is not None and complete:
+        try:
+            await run_in_threadpool(semantic_cache.insert, cache_scope, query, query_vector, result)
+        except Exception:
+            logger.warning("Semantic cache insert failed", exc_info=True)
+    return result
+
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
     return {"message": "Financial Document Analyzer API is running"}
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """LLM response cache hit-rate and size"""
+    return llm_cache.stats()
+
+
+async def _store_upload(file: UploadFile, detach: bool = False) -> Tuple[PdfSource, Optional[str]]:
+    """
+    Returns (document, file_path). Uploads up to SPOOL_MAX_BYTES are hashed and parsed
+    straight from Starlette's own spooled file (file_path is None), so they never touch
+    data/. FastAPI closes that file once the endpoint returns, so `detach=True` (used when
+    the work outlives the endpoint) reads it into bytes instead. Larger or unsized uploads
+    are written under data/, so parse-pool workers open the path rather than each being
+    sent the whole file.
+    """
+    if file.size is not None and file.size <= SPOOL_MAX_BYTES:
+        return (await file.read() if detach else file.file), None
+
+    file_id = str(uuid.uuid4())
+    os.makedirs("data", exist_ok=True)
+    file_path = f"data/financial_document_{file_id}.pdf"
+    await run_in_threadpool(_save_upload, file, file_path)
+    return file_path, file_path
+
+
+def _release_upload(document: Optional[PdfSource]) -> None:
+    # Spooled uploads are file objects (bytes once detached); on-disk ones are plain paths
+    if hasattr(document, "close"):
+        document.close()
+
+
+def _remove_upload(file_path: str) -> None:
+    # Parsed text is already cached by content hash, so re-uploads still skip parsing
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
 @app.post("/analyze")
 async def analyze_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    query: str = Form(default="Analyze this financial document for investment insights"),
+    query: str = Form(default=DEFAULT_QUERY),
+    enable_web_search: bool = Form(default=False),
 ):
     """
     Analyze a PDF financial document and provide investment recommendations.
     """
     if not query or not query.strip():
-        query = "Analyze this financial document for investment insights"
-
-    file_id = str(uuid.uuid4())
-    os.makedirs("data", exist_ok=True)
-    file_path = f"data/financial_document_{file_id}.pdf"
+        query = DEFAULT_QUERY
 
+    document, file_path = None, None
     try:
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
+        document, file_path = await _store_upload(file)
+        if file_path:
+            # Delete only after the response has been sent
+            background_tasks.add_task(_remove_upload, file_path)
+
+        result = await run_crew(
+            query=query.strip(), document=document, enable_web_search=enable_web_search
+        )
 
-        result = run_crew(query=query.strip(), file_path=file_path)
+        if result.get("status") == "rejected":
+            return {
+                "status": "rejected",
+                "query": query.strip(),
+                "reason": result["reason"],
+                "verification": result["verification"],
+                "file_processed": file.filename,
+            }
 
         return {
             "status": "success",
@@ -92,19 +419,88 @@ async def analyze_document(
         }
 
     except Exception as e:
+        # Background tasks only run after a successful response; clean up now instead
+        if file_path:
+            await run_in_threadpool(_remove_upload, file_path)
         raise HTTPException(status_code=500, detail=f"Error processing financial document: {str(e)}")
 
-    # NOTE: If you want to auto-clean after agents finish reading,
-    # move cleanup into a background-safe workflow. Left disabled intentionally.
-    # finally:
-    #     try:
-    #         if os.path.exists(file_path):
-    #             os.remove(file_path)
-    #     except Exception:
-    #         pass
+    finally:
+        _release_upload(document)
+
+
+@app.post("/analyze/stream")
+async def analyze_document_stream(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    query: str = Form(default=DEFAULT_QUERY),
+    enable_web_search: bool = Form(default=False),
+):
+    """
+    Same pipeline as /analyze, streamed as newline-delimited JSON events:
+    {"stage": ..., "delta": ...} for LLM tokens, {"stage": ..., "output": ...}
+    as each stage completes, then a final {"stage": "done", "analysis": ...}.
+    """
+    if not query or not query.strip():
+        query = DEFAULT_QUERY
+
+    try:
+        document, file_path = await _store_upload(file, detach=True)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing financial document: {str(e)}")
+
+    if file_path:
+        # Attached to the StreamingResponse, so it runs once the last event is sent
+        background_tasks.add_task(_remove_upload, file_path)
+
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+
+    def sink(event: Optional[Dict[str, Any]]) -> None:
+        # Called from crew worker threads as well as the loop itself
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    async def produce() -> None:
+        _progress_sink.set(sink)
+        try:
+            result = await run_crew(
+                query=query.strip(), document=document, enable_web_search=enable_web_search
+            )
+            sink({"stage": "done", "analysis": result, "file_processed": file.filename})
+        except Exception as e:
+            sink({"stage": "error", "detail": f"Error processing financial document: {str(e)}"})
+        finally:
+            _release_upload(document)
+            sink(None)
+
+    async def events():
+        producer = asyncio.create_task(produce())
+        try:
+            while (event := await queue.get()) is not None:
+                yield json.dumps(event, default=str) + "\n"
+            await producer
+        finally:
+            # Client disconnected mid-stream: don't start further crew stages for it
+            if not producer.done():
+                producer.cancel()
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 
 if __name__ == "__main__":
     import uvicorn
-    # Run: uvicorn app:app --reload
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # Production: gunicorn -c gunicorn.conf.py main:app  (one uvloop/httptools worker per core)
+    # Development: UVICORN_RELOAD=true python main.py  (single process, reloads on change)
+    reload = os.getenv("UVICORN_RELOAD", "false").lower() == "true"
+    workers = 1 if reload else int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    # Workers re-import main:app and read this to size their share of the per-host
+    # budgets (PDF parse pool, OpenAI throttle), as under gunicorn.conf.py
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=reload,
+        workers=None if reload else workers,
+        loop="uvloop",
+        http="httptools",
+    )
@@ -0,0 +1,68 @@
+# schemas.py
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field, field_validator
+
+
+# --- Structured task outputs (validated by CrewAI via Task.output_json) ---
+class VerificationOut(BaseModel):
+    is_financial_document: bool
+    confidence_score: float
+    reason: str
+
+
+class KPI(BaseModel):
+    name: str
+    value: str
+    unit: Optional[str] = None
+    source_page: Optional[int] = None
+
+
+class Excerpt(BaseModel):
+    text: str  # short verbatim passage, at most ~200 tokens
+    source_page: Optional[int] = None
+
+
+class AnalysisOut(BaseModel):
+    """
+    Compact per-document facts table. Investment and risk work only from this,
+    never the full document text.
+    """
+    company: str
+    period: str
+    kpis: List[KPI]
+    highlights: List[str]
+    guidance: List[str]
+    excerpts: List[Excerpt] = Field(default_factory=list)
+
+
+class InvestmentOut(BaseModel):
+    stance: Literal["buy", "hold", "sell"]
+    bull_case: str
+    bear_case: str
+    catalysts: List[str]
+    time_horizon_months: int
+
+    @field_validator("stance", mode="before")
+    @classmethod
+    def _normalize_stance(cls, value):
+        # Accept "Buy", " HOLD " etc. instead of failing into a converter retry
+        return value.strip().lower() if isinstance(value, str) else value
+
+
+class Risk(BaseModel):
+    category: str
+    description: str
+    evidence: str
+
+
+class RiskOut(BaseModel):
+    risks: List[Risk]
+
+
+class CompositeOut(BaseModel):
+    """All four task outputs from a single call (small-document fast path)."""
+    verification: VerificationOut
+    analysis: AnalysisOut
+    investment: InvestmentOut
+    risk: RiskOut
@@ -1,17 +1,32 @@
 # tools.py
+import contextlib
+import io
+import logging
+import math
+import multiprocessing
 import os
-from typing import Optional
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import IO, Optional, Union
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from crewai_tools import SerperDevTool
-from langchain_community.document_loaders import PyPDFLoader
+import pypdfium2 as pdfium
+
+from cache import file_sha256
 from crewai_tools import (
     FileReadTool,
     SerperDevTool,
 )
 
+logger = logging.getLogger(__name__)
+
 # --- Web search tool (requires SERPER_API_KEY in .env) ---
 search_tool = SerperDevTool()
 
@@ -23,6 +38,238 @@ financial_pdf_tool = FileReadTool(
     path=None  # Path will be passed dynamically when agents run
 )
 
+def _normalize_whitespace(text: str) -> str:
+    # str.split()/join both run in C; measured ~3x faster than re.sub(r"\s+", " ", ...)
+    return " ".join(text.split())
+
+
+# A document is either a path on disk or an in-memory upload (file-like or raw bytes)
+PdfSource = Union[str, os.PathLike, IO[bytes], bytes]
+
+
+def _materialize(source: PdfSource) -> Union[str, bytes]:
+    """
+    Paths stay paths; file-likes are read into bytes. Only needed where a file
+    object won't do (the parse pool, Docling); pdfium reads file-likes directly.
+    """
+    if isinstance(source, (str, bytes)):
+        return source
+    if isinstance(source, os.PathLike):
+        return os.fspath(source)
+    source.seek(0)
+    return source.read()
+
+
+# --- PDF parsing: fast text-layer pass, OCR only when that comes back empty ---
+# Below this many characters the PDF is assumed to be scanned (no text layer).
+MIN_TEXT_LAYER_CHARS = 200
+
+
+@lru_cache(maxsize=1)
+def _full_converter():
+    """
+    Docling converter with OCR + table structure, built on first use.
+    Docling is optional (it pulls in its own ML stack); without it scanned
+    PDFs just return whatever the text layer had.
+    """
+    try:
+        from docling.datamodel.base_models import InputFormat
+        from docling.datamodel.pipeline_options import PdfPipelineOptions
+        from docling.document_converter import DocumentConverter, PdfFormatOption
+    except ImportError:
+        return None
+
+    options = PdfPipelineOptions(do_ocr=True, do_table_structure=True)
+    return DocumentConverter(
+        format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=options)}
+    )
+
+
+def _available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        return os.cpu_count() or 1
+
+
+# Documents with more than this many pages are split across the parse pool;
+# smaller ones are parsed in-process.
+PARALLEL_MIN_PAGES = 5
+# Parse processes per server process. Every gunicorn worker gets its own pool,
+# so the available cores are divided between them rather than multiplied.
+PDF_PARSE_WORKERS = int(os.getenv(
+    "PDF_PARSE_WORKERS",
+    max(1, _available_cpus() // int(os.getenv("WEB_CONCURRENCY", "1"))),
+))
+
+_parse_executor: Optional[ProcessPoolExecutor] = None
+_parse_executor_lock = threading.Lock()
+
+
+def _parse_pool() -> ProcessPoolExecutor:
+    """
+    Long-lived parse pool, created on first use. Requests parse from threadpool
+    threads, and forking a multi-threaded server can deadlock the child, so
+    workers come from a forkserver (spawn where that doesn't exist).
+    """
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _parse_executor = ProcessPoolExecutor(max_workers=PDF_PARSE_WORKERS, mp_context=context)
+        return _parse_executor
+
+
+def _reset_parse_pool(broken: ProcessPoolExecutor) -> None:
+    """Drop a pool whose worker died so the next parse starts a fresh one."""
+    global _parse_executor
+    with _parse_executor_lock:
+        if _parse_executor is broken:
+            _parse_executor = None
+    broken.shutdown(wait=False)
+
+
+# PDFium is not thread-safe, even across different documents, and requests parse
+# from concurrent threadpool threads. Every pdfium call made in this process holds
+# this lock; worker processes each have their own PDFium and don't need it.
+_PDFIUM_LOCK = threading.Lock()
+
+
+def _extract_page_range(source: PdfSource, start: int, stop: int) -> tuple:
+    """Raw text of pages [start, stop); runs in a pool worker, or in-process under _PDFIUM_LOCK."""
+    pdf = pdfium.PdfDocument(source)
+    try:
+        pages = []
+        for index in range(start, stop):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            pages.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return start, pages
+    finally:
+        pdf.close()
+
+
+def _extract_text_layer(source: PdfSource) -> list:
+    """
+    Raw text of every page via pdfium (fast; no OCR or layout analysis).
+    Documents over PARALLEL_MIN_PAGES pages are split into page ranges parsed
+    in parallel by the parse pool, then merged back in page order.
+    """
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(source)
+        try:
+            num_pages = len(pdf)
+        finally:
+            pdf.close()
+
+    if num_pages <= PARALLEL_MIN_PAGES or PDF_PARSE_WORKERS == 1:
+        with _PDFIUM_LOCK:
+            return _extract_page_range(source, 0, num_pages)[1]
+
+    # One contiguous page range per pool worker
+    chunk_size = math.ceil(num_pages / PDF_PARSE_WORKERS)
+    ranges = [(lo, min(lo + chunk_size, num_pages)) for lo in range(0, num_pages, chunk_size)]
+
+    # Workers need a picklable source: file-likes are read into bytes only here
+    payload = _materialize(source)
+    executor = _parse_pool()
+    try:
+        futures = [executor.submit(_extract_page_range, payload, lo, hi) for lo, hi in ranges]
+        chunks = sorted(future.result() for future in futures)
+    except BrokenProcessPool:
+        logger.warning("PDF parse pool died; parsing in-process", exc_info=True)
+        _reset_parse_pool(executor)
+        with _PDFIUM_LOCK:
+            return _extract_page_range(payload, 0, num_pages)[1]
+
+    pages = []
+    for _, chunk_pages in chunks:
+        pages.extend(chunk_pages)
+    return pages
+
+
+# --- Parsed PDF text, keyed by file content hash ---
+# In-memory LRU in front of an on-disk copy so re-uploads and process restarts skip parsing.
+PDF_TEXT_CACHE_DIR = os.path.join("data", "cache", "pdf_text")
+_PDF_TEXT_CACHE_MAX = 128
+# Oldest-used files beyond this are deleted so data/ doesn't grow without bound
+PDF_TEXT_CACHE_MAX_FILES = int(os.getenv("PDF_TEXT_CACHE_MAX_FILES", "512"))
+_pdf_text_cache: "OrderedDict[str, str]" = OrderedDict()
+# Requests read PDFs from threadpool threads; OrderedDict isn't safe to mutate concurrently
+_pdf_text_cache_lock = threading.Lock()
+
+
+def _recall_pdf_text(digest: str) -> Optional[str]:
+    with _pdf_text_cache_lock:
+        text = _pdf_text_cache.get(digest)
+        if text is not None:
+            _pdf_text_cache.move_to_end(digest)
+        return text
+
+
+def _remember_pdf_text(digest: str, text: str) -> None:
+    with _pdf_text_cache_lock:
+        _pdf_text_cache[digest] = text
+        _pdf_text_cache.move_to_end(digest)
+        while len(_pdf_text_cache) > _PDF_TEXT_CACHE_MAX:
+            _pdf_text_cache.popitem(last=False)
+
+
+def _persist_pdf_text(cache_file: str, text: str) -> None:
+    """Best-effort on-disk copy; a failed write only costs a re-parse later."""
+    tmp_file = None
+    try:
+        os.makedirs(PDF_TEXT_CACHE_DIR, exist_ok=True)
+        # Unique temp file, then atomic rename, so concurrent writers never share
+        # a file and readers never see a half-written one
+        fd, tmp_file = tempfile.mkstemp(dir=PDF_TEXT_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_file, cache_file)
+        _prune_pdf_text_dir()
+    except OSError:
+        logger.warning("Could not write PDF text cache file %s", cache_file, exc_info=True)
+        if tmp_file:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+
+
+def _prune_pdf_text_dir() -> None:
+    """Keep the PDF_TEXT_CACHE_MAX_FILES most recently used files (hits touch mtime); 0 = no cap."""
+    if not PDF_TEXT_CACHE_MAX_FILES:
+        return
+    entries = []
+    for entry in os.scandir(PDF_TEXT_CACHE_DIR):
+        if entry.name.endswith(".txt"):
+            with contextlib.suppress(OSError):
+                entries.append((entry.stat().st_mtime, entry.path))
+    if len(entries) <= PDF_TEXT_CACHE_MAX_FILES:
+        return
+    entries.sort(reverse=True)
+    for _, path in entries[PDF_TEXT_CACHE_MAX_FILES:]:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+def _load_pdf_text(cache_file: str) -> Optional[str]:
+    """On-disk copy, or None if missing (possibly pruned by another worker just now)."""
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            text = f.read()
+        os.utime(cache_file)  # recency for _prune_pdf_text_dir
+    except OSError:
+        return None
+    return text
+
+
+def _ocr_skipped(text: str) -> bool:
+    """Text-layer-only result of a scanned PDF because docling isn't installed."""
+    return len(text.strip()) < MIN_TEXT_LAYER_CHARS and _full_converter() is None
+
+
 # --- Proper CrewAI BaseTool subclass for reading PDFs ---
 class FinancialDocumentReadTool:
     """
@@ -41,18 +288,66 @@ class FinancialDocumentReadTool:
             return f"Error: File not found at path: {path}"
 
         try:
-            loader = PyPDFLoader(path)
-            docs = loader.load()
+            return self.read(path)
         except Exception as e:
             return f"Error reading PDF: {e}"
 
+    def read(self, source: PdfSource, digest: Optional[str] = None) -> str:
+        """
+        Normalized text of the PDF at `source` (a path or an in-memory upload),
+        parsed at most once per file content. Pass `digest` when the caller
+        already has the file's SHA-256. Raises on parse errors.
+        """
+        digest = digest or file_sha256(source)
+        text = _recall_pdf_text(digest)
+        if text is not None:
+            return text
+
+        cache_file = os.path.join(PDF_TEXT_CACHE_DIR, f"{digest}.txt")
+        text = _load_pdf_text(cache_file)
+        # A near-empty copy from before docling was installed gets OCR'd now
+        if text is not None and (len(text.strip()) >= MIN_TEXT_LAYER_CHARS or _ocr_skipped(text)):
+            _remember_pdf_text(digest, text)
+            return text
+
+        text = self._extract_text(source)
+
+        _remember_pdf_text(digest, text)
+        # Don't pin an un-OCR'd scan on disk; installing docling later should fix it
+        if not _ocr_skipped(text):
+            _persist_pdf_text(cache_file, text)
+        return text
+
+    @staticmethod
+    def _extract_text(source: PdfSource) -> str:
+        label = os.fspath(source) if isinstance(source, (str, os.PathLike)) else "in-memory upload"
+        raw_pages = _extract_text_layer(source)
+
         # Normalize whitespace and concatenate pages
-        pages = []
-        for d in docs:
-            content = " ".join(d.page_content.split())
-            pages.append(content)
-        return "\n".join(pages)
+        text = "\n".join(_normalize_whitespace(page_content) for page_content in raw_pages)
+
+        if len(text.strip()) >= MIN_TEXT_LAYER_CHARS:
+            logger.info("Parsed %s with fast text-layer tier", label)
+            return text
+
+        converter = _full_converter()
+        if converter is None:
+            logger.warning("No text layer in %s and docling is not installed; skipping OCR", label)
+            return text
+
+        logger.info("No text layer in %s; falling back to OCR tier", label)
+        source = _materialize(source)
+        if isinstance(source, bytes):
+            from docling.datamodel.base_models import DocumentStream
+            source = DocumentStream(name="upload.pdf", stream=io.BytesIO(source))
+        # Docling's PDF backend renders pages through pypdfium2 in this process
+        with _PDFIUM_LOCK:
+            ocr_text = converter.convert(source).document.export_to_text()
+        return _normalize_whitespace(ocr_text)
+
 
+# Shared reader: main.py extracts each upload once and hands the text to every task
+financial_document_reader = FinancialDocumentReadTool()
 
 
 ## Creating Investment Analysis Tool